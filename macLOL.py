@@ -9,8 +9,11 @@ that the finger has the apropriate values.
 
 """
 
-import numpy as np
+import itertools
+import numbers
+import operator
 import random
+import threading
 
 MAX_WIDTH = 30
 
@@ -36,6 +39,25 @@ def euclid_extended(a, b):
         y, lasty = lasty - quotient * y, y
     return lastx, lasty
 
+def crt_basis(moduli):
+    """Returns (basis, product) such that the solution for any residues is
+    sum(residue * b for residue, b in zip(residues, basis)) % product.
+
+    Computing the basis once lets many fingers share the extended Euclid
+    work.
+
+    >>> basis, product = crt_basis([3, 4, 5])
+    >>> sum(r * b for r, b in zip([2, 3, 1], basis)) % product
+    11
+
+    """
+    product = reduce(operator.mul, moduli, 1)
+    basis = []
+    for modulus in moduli:
+        x, y = euclid_extended(modulus, product / modulus)
+        basis.append(y * (product / modulus))
+    return basis, product
+
 def chinese_remainder_theorem(residues, moduli):
     """
     See http://en.wikipedia.org/wiki/Chinese_remainder_theorem
@@ -44,13 +66,8 @@ def chinese_remainder_theorem(residues, moduli):
     11
 
     """
-    product = np.product(moduli)
-    summation = 0
-
-    for i in xrange(len(residues)):
-        x, y = euclid_extended(moduli[i], product / moduli[i])
-        summation += residues[i] * y * (product / moduli[i])
-    return summation % product
+    basis, product = crt_basis(moduli)
+    return sum(residue * b for residue, b in zip(residues, basis)) % product
 
 def pprime(n):
     """
@@ -161,28 +178,41 @@ class MemPool(object):
      0: EA  1: EA  2: EB  3: EB 
 
     """
-    def __init__(self, size, arena=None, finger=None):
+    def __init__(self, size, arena=None, finger=None, residues=None):
         self.size = size
         self.used = [False for _ in xrange(self.size)]
         self.num_used = 0
-        if arena:
-            self.arena = arena
-        else:
-            self.arena = [None for _ in xrange(self.size)]
-
-        if arena and isinstance(arena, MemPool):
-            self.moduli = self.arena.moduli
+        # The slots of the parent pool that back this one. freeLOL hands
+        # them back.
+        self.residues = residues
+
+        if isinstance(arena, MemPool):
+            # Nested pools are flattened: their finger maps straight to the
+            # root arena, so an access is a single lookup no matter how deep
+            # the nesting goes.
+            self.parent = arena
+            self.arena = arena.arena
+            self.moduli = arena.moduli
+            self.basis, self.product = arena.basis, arena.product
         else:
+            self.parent = None
+            if arena:
+                self.arena = arena
+            else:
+                self.arena = [None for _ in xrange(self.size)]
             self.moduli = create_moduli(self.size)
+            self.basis, self.product = crt_basis(self.moduli)
 
-        if finger:
+        if finger is not None:
             self.finger = finger
         else:
-            self.finger = chinese_remainder_theorem(list(xrange(self.size)),
-                                                    self.moduli)
+            self.finger = self._finger(xrange(self.size))
+
+    def _finger(self, slots):
+        return sum(slot * b for slot, b in zip(slots, self.basis)) % self.product
 
     def __getitem__(self, key):
-        if isinstance(key, int):
+        if isinstance(key, numbers.Integral):
             return self.arena[self.finger % self.moduli[key]]
         elif isinstance(key, slice):
             return [self.arena[self.finger % self.moduli[val]]
@@ -191,7 +221,7 @@ class MemPool(object):
             raise TypeError("Invalid argument type.")
 
     def __setitem__(self, key, item):
-        if isinstance(key, int):
+        if isinstance(key, numbers.Integral):
             self.arena[self.finger % self.moduli[key]] = item
         elif isinstance(key, slice):
             for index in xrange(key.start, key.stop, key.step):
@@ -203,19 +233,8 @@ class MemPool(object):
         return self.size
 
     def __iter__(self):
-        return self
-
-    def next(self):
-        try:
-            self._iter_index += 1
-        except AttributeError:
-            self._iter_index = 0
-
-        if self._iter_index >= self.size:
-            self._iter_index = 0
-            raise StopIteration()
-        else:
-            return self[self._iter_index]
+        for index in xrange(self.size):
+            yield self[index]
 
     def __str__(self):
         width = 0
@@ -237,30 +256,155 @@ class MemPool(object):
         return ''.join(builder)
 
     def macLOL(self, size):
-        if size > self.size - self.num_used:
+        return self.macLOL_many([size])[0]
+
+    def macLOL_many(self, sizes):
+        """Allocates one block per entry of sizes in a single pass.
+
+        >>> M = MemPool(6)
+        >>> blocks = M.macLOL_many([2, 3])
+        >>> [len(block) for block in blocks]
+        [2, 3]
+        >>> inner = blocks[1].macLOL(2)
+        >>> inner[0], inner[1] = 'x', 'y'
+        >>> M[2:5]
+        ['x', 'y', None]
+        >>> inner.arena is M.arena
+        True
+
+        """
+        total = sum(sizes)
+        if total > self.size - self.num_used:
             raise MemoryError(
                     "{0} blocks requested but only {1} available.".format(
-                            size, self.size - self.num_used))
+                            total, self.size - self.num_used))
         else:
-            self.num_used += size
+            self.num_used += total
 
-        residues = []
-        index = 0
-        while len(residues) < size:
-            if not self.used[index]:
-                residues.append(index)
+        free = (index for index in xrange(self.size) if not self.used[index])
+        blocks = []
+        for size in sizes:
+            residues = list(itertools.islice(free, size))
+            for index in residues:
                 self.used[index] = True
-            index += 1
+            # Translate to root arena slots so the block skips this pool.
+            slots = [self.finger % self.moduli[index] for index in residues]
+            blocks.append(MemPool(size, arena=self, finger=self._finger(slots),
+                                  residues=residues))
+        return blocks
 
-        return MemPool(size, arena=self,
-                       finger=chinese_remainder_theorem(residues, self.moduli))
+    def _release(self, residues):
+        for index in residues:
+            self.used[index] = False
+        self.num_used -= len(residues)
 
     def freeLOL(self):
-        if not isinstance(self.arena, MemPool):
+        if self.parent is None:
             # The arena is a list(), so let the GC take care of it.
             pass
         else:
-            for i in xrange(self.size):
-                self.arena.used[self.finger % self.moduli[i]] = False
-            self.arena.num_used -= self.size
+            self.parent._release(self.residues)
+
+
+class _Shard(object):
+    def __init__(self, slots):
+        self.lock = threading.Lock()
+        # Popping from the end hands out the lowest slots first.
+        self.free = list(reversed(slots))
+
 
+class ConcurrentMemPool(MemPool):
+    """A root MemPool that can be shared between threads.
+
+    The slots are split into shards with one lock each. A thread allocates
+    from the shard it was assigned on first use and only falls back to
+    taking every shard lock (always in the same order) when its shard can't
+    satisfy the request. Freeing only locks the shards that own the slots.
+    The blocks handed out are plain MemPools, so a nested pool must not be
+    shared between threads.
+
+    >>> M = ConcurrentMemPool(6, shards=2)
+    >>> a = M.macLOL(2)
+    >>> b = M.macLOL(3)
+    >>> M.num_used
+    5
+    >>> a.freeLOL()
+    >>> M.num_used
+    3
+
+    """
+    def __init__(self, size, shards=8):
+        MemPool.__init__(self, size)
+        shards = max(1, min(shards, size))
+        self.shard_size = -(-size // shards)
+        self.shards = [_Shard(range(start, min(start + self.shard_size, size)))
+                       for start in xrange(0, size, self.shard_size)]
+        self._next_shard = itertools.count()
+        self._local = threading.local()
+
+    @property
+    def num_used(self):
+        return self.size - sum(len(shard.free) for shard in self.shards)
+
+    @num_used.setter
+    def num_used(self, value):
+        # The shards keep the count. MemPool.__init__ only resets it.
+        pass
+
+    def _home_shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            self._local.shard = self.shards[
+                    next(self._next_shard) % len(self.shards)]
+            return self._local.shard
+
+    def _take(self, total):
+        home = self._home_shard()
+        with home.lock:
+            if len(home.free) >= total:
+                return [home.free.pop() for _ in xrange(total)]
+
+        # Global fallback. Taking the locks in shard order can't deadlock.
+        for shard in self.shards:
+            shard.lock.acquire()
+        try:
+            available = sum(len(shard.free) for shard in self.shards)
+            if total > available:
+                raise MemoryError(
+                        "{0} blocks requested but only {1} available.".format(
+                                total, available))
+            residues = []
+            for shard in [home] + self.shards:
+                while shard.free and len(residues) < total:
+                    residues.append(shard.free.pop())
+            return residues
+        finally:
+            for shard in self.shards:
+                shard.lock.release()
+
+    def macLOL_many(self, sizes):
+        residues = self._take(sum(sizes))
+        for index in residues:
+            self.used[index] = True
+
+        blocks = []
+        start = 0
+        for size in sizes:
+            block_residues = residues[start:start + size]
+            start += size
+            slots = [self.finger % self.moduli[index]
+                     for index in block_residues]
+            blocks.append(MemPool(size, arena=self, finger=self._finger(slots),
+                                  residues=block_residues))
+        return blocks
+
+    def _release(self, residues):
+        by_shard = {}
+        for index in residues:
+            self.used[index] = False
+            by_shard.setdefault(index // self.shard_size, []).append(index)
+        for shard_index, indices in by_shard.iteritems():
+            shard = self.shards[shard_index]
+            with shard.lock:
+                shard.free.extend(indices)
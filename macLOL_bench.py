@@ -0,0 +1,418 @@
+"""macLOL_bench.py replays allocation traces against macLOL.MemPool and a
+naive first-fit allocator so that the two can be compared.
+
+A trace is a list of operations. Every operation is a dict with an "op" key
+that is either "alloc" or "free" and an "id" that names the block. Allocations
+also carry a "size". Traces are either generated synthetically or loaded from
+a JSON-lines log with one operation per line, e.g.
+
+    {"op": "alloc", "id": 0, "size": 3}
+    {"op": "free", "id": 0}
+
+For every allocator the replay reports alloc and free latency percentiles,
+the number of failed allocations, read throughput through __getitem__, the
+bit length of the fingers handed out and the peak amount of block metadata
+that was alive at once.
+
+"""
+
+import argparse
+import json
+import random
+import resource
+import sys
+import threading
+import timeit
+from multiprocessing.pool import ThreadPool
+
+import macLOL
+
+PERCENTILES = (50, 90, 99, 100)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values.
+
+    >>> percentile([4, 1, 3, 2], 50)
+    2
+    >>> percentile([4, 1, 3, 2], 100)
+    4
+    >>> percentile([], 50)
+
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, int(round(pct / 100.0 * len(ordered))) - 1)
+    return ordered[rank]
+
+
+def uniform_sizes(max_block, rand):
+    while True:
+        yield rand.randint(1, max_block)
+
+
+def power_law_sizes(max_block, rand, alpha=1.5):
+    while True:
+        yield min(max_block, int(rand.paretovariate(alpha)))
+
+
+SIZE_DISTRIBUTIONS = {
+    'uniform': uniform_sizes,
+    'power': power_law_sizes,
+}
+
+FREE_ORDERS = ('lifo', 'random')
+
+
+def synthetic_trace(num_ops, capacity, sizes='uniform', frees='lifo',
+                    max_block=8, seed=None):
+    """Generates a trace that never has more than capacity slots alive.
+
+    >>> trace = synthetic_trace(6, 10, seed=1)
+    >>> len(trace)
+    6
+    >>> sorted(set(op['op'] for op in trace))
+    ['alloc', 'free']
+
+    """
+    if frees not in FREE_ORDERS:
+        raise ValueError("Unknown free order: {0}".format(frees))
+    rand = random.Random(seed)
+    size_gen = SIZE_DISTRIBUTIONS[sizes](min(max_block, capacity), rand)
+    live = []
+    live_sizes = {}
+    in_use = 0
+    next_id = 0
+    trace = []
+    size = next(size_gen)
+    while len(trace) < num_ops:
+        if live and (in_use + size > capacity or rand.random() < 0.5):
+            if frees == 'lifo':
+                op_id = live.pop()
+            else:
+                op_id = live.pop(rand.randrange(len(live)))
+            in_use -= live_sizes.pop(op_id)
+            trace.append({'op': 'free', 'id': op_id})
+        else:
+            trace.append({'op': 'alloc', 'id': next_id, 'size': size})
+            live.append(next_id)
+            live_sizes[next_id] = size
+            in_use += size
+            next_id += 1
+            size = next(size_gen)
+    return trace
+
+
+def load_trace(path):
+    with open(path) as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+def save_trace(trace, path):
+    with open(path, 'w') as trace_file:
+        for op in trace:
+            trace_file.write(json.dumps(op, sort_keys=True) + "\n")
+
+
+class FirstFitPool(object):
+    """A baseline allocator that hands out contiguous runs of slots.
+
+    Unlike MemPool, it suffers from external fragmentation.
+
+    >>> F = FirstFitPool(4)
+    >>> a, b = F.macLOL(2), F.macLOL(2)
+    >>> a.freeLOL()
+    >>> F.macLOL(3)
+    Traceback (most recent call last):
+        ...
+    MemoryError: No run of 3 free blocks.
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self.used = [False for _ in xrange(self.size)]
+        self.arena = [None for _ in xrange(self.size)]
+
+    def macLOL(self, size):
+        run = 0
+        for index in xrange(self.size):
+            run = 0 if self.used[index] else run + 1
+            if run == size:
+                base = index - size + 1
+                for slot in xrange(base, index + 1):
+                    self.used[slot] = True
+                return _FirstFitBlock(self, base, size)
+        raise MemoryError("No run of {0} free blocks.".format(size))
+
+
+class _FirstFitBlock(object):
+    def __init__(self, pool, base, size):
+        self.pool = pool
+        self.base = base
+        self.size = size
+
+    def __getitem__(self, key):
+        return self.pool.arena[self.base + key]
+
+    def __setitem__(self, key, item):
+        self.pool.arena[self.base + key] = item
+
+    def __len__(self):
+        return self.size
+
+    def freeLOL(self):
+        for slot in xrange(self.base, self.base + self.size):
+            self.pool.used[slot] = False
+
+
+def _metadata_bytes(block):
+    finger = getattr(block, 'finger', None)
+    if finger is None:
+        return sys.getsizeof(block.base)
+    return sys.getsizeof(finger)
+
+
+def replay(pool, trace, access_rounds=10):
+    """Replays trace against pool and returns the raw measurements."""
+    timer = timeit.default_timer
+    blocks = {}
+    alloc_times = []
+    free_times = []
+    finger_bits = []
+    failures = 0
+    corrupt = 0
+    metadata = 0
+    peak_metadata = 0
+    maxrss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    for op in trace:
+        if op['op'] == 'alloc':
+            start = timer()
+            try:
+                block = pool.macLOL(op['size'])
+            except MemoryError:
+                failures += 1
+                continue
+            alloc_times.append(timer() - start)
+            for index in xrange(op['size']):
+                block[index] = op['id']
+            blocks[op['id']] = block
+            if hasattr(block, 'finger'):
+                finger_bits.append(block.finger.bit_length())
+            metadata += _metadata_bytes(block)
+            peak_metadata = max(peak_metadata, metadata)
+        elif op['op'] == 'free':
+            block = blocks.pop(op['id'], None)
+            if block is None:
+                # The allocation failed, so there is nothing to free.
+                continue
+            for index in xrange(len(block)):
+                if block[index] != op['id']:
+                    corrupt += 1
+            metadata -= _metadata_bytes(block)
+            start = timer()
+            block.freeLOL()
+            free_times.append(timer() - start)
+        else:
+            raise ValueError("Unknown trace op: {0}".format(op['op']))
+
+    reads = 0
+    start = timer()
+    for _ in xrange(access_rounds):
+        for block in blocks.itervalues():
+            for index in xrange(len(block)):
+                block[index]
+            reads += len(block)
+    access_time = timer() - start
+
+    return {
+        'alloc_times': alloc_times,
+        'free_times': free_times,
+        'finger_bits': finger_bits,
+        'failures': failures,
+        'corrupt': corrupt,
+        'reads': reads,
+        'access_time': access_time,
+        'peak_metadata_bytes': peak_metadata,
+        'maxrss_growth_kb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                             - maxrss_before),
+    }
+
+
+def summarize(result):
+    summary = {}
+    for key in ('alloc_times', 'free_times'):
+        summary[key] = dict((pct, percentile(result[key], pct))
+                            for pct in PERCENTILES)
+    summary['finger_bits'] = (max(result['finger_bits'])
+                              if result['finger_bits'] else None)
+    summary['reads_per_sec'] = (result['reads'] / result['access_time']
+                                if result['access_time'] else None)
+    for key in ('failures', 'corrupt', 'peak_metadata_bytes',
+                'maxrss_growth_kb'):
+        summary[key] = result[key]
+    return summary
+
+
+ALLOCATORS = (
+    ('macLOL', macLOL.MemPool),
+    ('first-fit', FirstFitPool),
+)
+
+
+def compare(trace, pool_size, access_rounds=10):
+    """Replays trace against every allocator in ALLOCATORS."""
+    return [(name, summarize(replay(factory(pool_size), trace,
+                                    access_rounds=access_rounds)))
+            for name, factory in ALLOCATORS]
+
+
+class _LockedMemPool(object):
+    """The baseline for bench_concurrent: a MemPool behind one global lock."""
+    def __init__(self, size):
+        self.pool = macLOL.MemPool(size)
+        self.lock = threading.Lock()
+
+    def macLOL(self, size):
+        with self.lock:
+            return self.pool.macLOL(size)
+
+    def free(self, block):
+        with self.lock:
+            block.freeLOL()
+
+
+class _SharedMemPool(object):
+    def __init__(self, size):
+        self.pool = macLOL.ConcurrentMemPool(size)
+
+    def macLOL(self, size):
+        return self.pool.macLOL(size)
+
+    def free(self, block):
+        block.freeLOL()
+
+
+CONCURRENT_ALLOCATORS = (
+    ('macLOL sharded', _SharedMemPool),
+    ('macLOL global lock', _LockedMemPool),
+)
+
+
+def _churn(pool, trace):
+    blocks = {}
+    failures = 0
+    for op in trace:
+        if op['op'] == 'alloc':
+            try:
+                block = pool.macLOL(op['size'])
+            except MemoryError:
+                failures += 1
+                continue
+            for index in xrange(op['size']):
+                block[index] = op['id']
+            blocks[op['id']] = block
+        else:
+            block = blocks.pop(op['id'], None)
+            if block is not None:
+                pool.free(block)
+    for block in blocks.itervalues():
+        pool.free(block)
+    return failures
+
+
+def bench_concurrent(threads, pool_size, ops, max_block=8, seed=None):
+    """Runs one synthetic trace per thread against a shared pool.
+
+    Each thread only keeps pool_size / threads slots alive, so failures come
+    from contention rather than from an oversized workload.
+    """
+    traces = [synthetic_trace(ops, max(1, pool_size // threads),
+                              max_block=max_block,
+                              seed=None if seed is None else seed + i)
+              for i in xrange(threads)]
+    workers = ThreadPool(threads)
+    try:
+        results = []
+        for name, factory in CONCURRENT_ALLOCATORS:
+            pool = factory(pool_size)
+            start = timeit.default_timer()
+            failures = sum(workers.map(lambda trace: _churn(pool, trace),
+                                       traces))
+            elapsed = timeit.default_timer() - start
+            results.append((name, {'ops_per_sec': threads * ops / elapsed,
+                                   'failures': failures}))
+        return results
+    finally:
+        workers.close()
+        workers.join()
+
+
+def format_concurrent_report(results):
+    return "\n".join(
+            "{0}: {1[ops_per_sec]:.0f} ops/sec, {1[failures]} failed allocs"
+            .format(name, summary) for name, summary in results)
+
+
+def _format_us(seconds):
+    return "-" if seconds is None else "{0:.1f}".format(seconds * 1e6)
+
+
+def format_report(results):
+    builder = []
+    for name, summary in results:
+        builder.append("{0}:".format(name))
+        for key, label in (('alloc_times', 'alloc'), ('free_times', 'free')):
+            builder.append("  {0} us: {1}".format(label, "  ".join(
+                    "p{0}={1}".format(pct, _format_us(summary[key][pct]))
+                    for pct in PERCENTILES)))
+        builder.append("  failed allocs: {failures}  corrupt reads: {corrupt}"
+                       .format(**summary))
+        builder.append("  reads/sec: {0}".format(
+                "-" if summary['reads_per_sec'] is None
+                else "{0:.0f}".format(summary['reads_per_sec'])))
+        builder.append("  max finger bits: {0}".format(summary['finger_bits']))
+        builder.append("  peak metadata bytes: {peak_metadata_bytes}  "
+                       "maxrss growth (KB): {maxrss_growth_kb}"
+                       .format(**summary))
+    return "\n".join(builder)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--trace', help="JSON-lines trace to replay.")
+    parser.add_argument('--record', help="Write the replayed trace here.")
+    parser.add_argument('--pool-size', type=int, default=64)
+    parser.add_argument('--ops', type=int, default=2000)
+    parser.add_argument('--sizes', choices=sorted(SIZE_DISTRIBUTIONS),
+                        default='uniform')
+    parser.add_argument('--frees', choices=FREE_ORDERS, default='lifo')
+    parser.add_argument('--max-block', type=int, default=8)
+    parser.add_argument('--access-rounds', type=int, default=10)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--threads', type=int,
+                        help="Benchmark a pool shared by this many threads.")
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        print format_concurrent_report(bench_concurrent(
+                args.threads, args.pool_size, args.ops,
+                max_block=args.max_block, seed=args.seed))
+        return
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.ops, args.pool_size, sizes=args.sizes,
+                                frees=args.frees, max_block=args.max_block,
+                                seed=args.seed)
+    if args.record:
+        save_trace(trace, args.record)
+
+    print format_report(compare(trace, args.pool_size,
+                                access_rounds=args.access_rounds))
+
+
+if __name__ == '__main__':
+    main()
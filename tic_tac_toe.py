@@ -1,12 +1,25 @@
 from pprint import pprint
+from collections import OrderedDict
 from copy import deepcopy
+import cPickle
+import multiprocessing
 import random
 import sys
+import time
+
+import numpy as np
 
 X = "X"
 O = "0"
 E = " "
 
+# The player and winner columns of StateChart arrays.
+PLAYERS = (X, O)
+WINNERS = (X, O, E)
+
+# Self-play is handed to worker processes in tasks of this many games.
+GAMES_PER_TASK = 10000
+
 STATE_COMPONENTS = (
         #(0, 0),
         #(0, 1),
@@ -30,43 +43,385 @@ class Spot(object):
         return "row: {self.row} col: {self.col}".format(self=self)
 
 
+def state_components(k):
+    """The (x_count, o_count) line features tracked for k-in-a-row.
+
+    These are the same as STATE_COMPONENTS when k is 3.
+
+    """
+    return ((0, k - 1), (0, k), (k - 1, 0), (k, 0), None)
+
+
+class Geometry(object):
+    """The squares and lines of an m,n,k-game: rows x cols, k in a row.
+
+    Square cols * row + col of a bitboard is set when that square is taken.
+    Use geometry() rather than building these directly so that each board
+    shape is only laid out once.
+
+    """
+    def __init__(self, rows, cols, k):
+        self.rows = rows
+        self.cols = cols
+        self.k = k
+        self.num_squares = rows * cols
+        self.full = (1 << self.num_squares) - 1
+        self.spots = tuple(Spot(r, c)
+                           for r in range(rows) for c in range(cols))
+
+        # Every run of k squares in a row, col or diagonal.
+        lines = []
+        for dr, dc in ((1, 0), (0, 1), (1, 1), (-1, 1)):
+            for r in range(rows):
+                for c in range(cols):
+                    end_r, end_c = r + dr * (k - 1), c + dc * (k - 1)
+                    if 0 <= end_r < rows and 0 <= end_c < cols:
+                        lines.append(tuple(cols * (r + dr * i) + c + dc * i
+                                           for i in range(k)))
+        if not lines:
+            raise ValueError("No line of {0} fits on a {1}x{2} board.".format(
+                    k, rows, cols))
+        self.line_masks = tuple(sum(1 << square for square in line)
+                                for line in lines)
+        # lines_through[square] holds the indices of the lines that a move
+        # on square can change.
+        self.lines_through = tuple(
+                tuple(i for i, line in enumerate(lines) if square in line)
+                for square in range(self.num_squares))
+
+        # line_feature[x_count][o_count] is the position in components of a
+        # line holding that many X's and O's.
+        self.components = state_components(k)
+        self.line_feature = tuple(
+                tuple(self.components.index((x_count, o_count))
+                      if (x_count, o_count) in self.components
+                      else self.components.index(None)
+                      for o_count in range(k + 1))
+                for x_count in range(k + 1))
+        self.x_wins = self.components.index((k, 0))
+        self.o_wins = self.components.index((0, k))
+
+    def __reduce__(self):
+        # Unpickle to the shared instance, so identity checks keep working.
+        return geometry, (self.rows, self.cols, self.k)
+
+
+_geometries = {}
+
+def geometry(rows=3, cols=3, k=3):
+    """Returns the shared Geometry for a rows x cols, k in a row game."""
+    if (rows, cols, k) not in _geometries:
+        _geometries[rows, cols, k] = Geometry(rows, cols, k)
+    return _geometries[rows, cols, k]
+
+TIC_TAC_TOE = geometry()
+
+FULL_BOARD = TIC_TAC_TOE.full
+
+LINE_MASKS = TIC_TAC_TOE.line_masks
+
+POPCOUNT = tuple(bin(bits).count('1') for bits in range(FULL_BOARD + 1))
+
+# TRIO_FEATURE[x_count][o_count] is the position in STATE_COMPONENTS of a
+# trio holding that many X's and O's.
+TRIO_FEATURE = TIC_TAC_TOE.line_feature
+
+SPOTS = TIC_TAC_TOE.spots
+
+def line_features(xbits, obits):
+    """Returns the STATE_COMPONENTS feature tuple of a position."""
+    # Since these represent states, we need to be able to account for
+    # the case where we have a win. Furthermore, the total number of
+    # entries in a trio cannot exceed 3.
+    counts = [0] * len(STATE_COMPONENTS)
+    for mask in LINE_MASKS:
+        counts[TRIO_FEATURE[POPCOUNT[xbits & mask]]
+                           [POPCOUNT[obits & mask]]] += 1
+    return tuple(counts)
+
+def line_winner(xbits, obits, geometry=None):
+    line_masks = geometry.line_masks if geometry else LINE_MASKS
+    for player, bits in ((X, xbits), (O, obits)):
+        for mask in line_masks:
+            if bits & mask == mask:
+                return player
+    return E
+
+def _symmetries():
+    rotate = lambda (r, c): (c, 2 - r)
+    reflect = lambda (r, c): (r, 2 - c)
+    symmetries = []
+    for flip in (False, True):
+        for turns in range(4):
+            perm = []
+            for r in range(3):
+                for c in range(3):
+                    spot = reflect((r, c)) if flip else (r, c)
+                    for _ in range(turns):
+                        spot = rotate(spot)
+                    perm.append(3 * spot[0] + spot[1])
+            symmetries.append(tuple(perm))
+    return tuple(symmetries)
+
+# Each symmetry of the board as a map from square to square.
+SYMMETRIES = _symmetries()
+
+# SYMMETRY_BITS[k][bits] is bits with symmetry k applied.
+SYMMETRY_BITS = tuple(
+        tuple(sum(1 << perm[square] for square in range(9)
+                  if bits >> square & 1)
+              for bits in range(FULL_BOARD + 1))
+        for perm in SYMMETRIES)
+
+def canonical_position(xbits, obits):
+    """Returns the smallest of the 8 symmetric variants of a position."""
+    return min((table[xbits], table[obits]) for table in SYMMETRY_BITS)
+
+
+class StateTable(object):
+    """Every position reachable from the empty board, indexed once.
+
+    For position i, positions[i] is its (xbits, obits), successors[i][square]
+    is the index reached by playing square (-1 if that move is illegal or
+    the game is over), features[i] is its feature tuple, outcomes[i] is the
+    winner (E for a draw, None if the game goes on) and canonical[i] numbers
+    its class under the 8 board symmetries.
+
+    >>> table = StateTable()
+    >>> len(table.positions), table.num_canonical
+    (5478, 765)
+
+    """
+    def __init__(self):
+        self.positions = []
+        self.index = {}
+        self.successors = []
+        self.features = []
+        self.outcomes = []
+        self.canonical = []
+        canonical_ids = {}
+
+        self._add(0, 0)
+        i = 0
+        while i < len(self.positions):
+            xbits, obits = self.positions[i]
+            successors = [-1] * 9
+            if self.outcomes[i] is None:
+                x_to_move = POPCOUNT[xbits] == POPCOUNT[obits]
+                for square in range(9):
+                    bit = 1 << square
+                    if not (xbits | obits) & bit:
+                        nxt = ((xbits | bit, obits) if x_to_move
+                               else (xbits, obits | bit))
+                        if nxt not in self.index:
+                            self._add(*nxt)
+                        successors[square] = self.index[nxt]
+            self.successors.append(tuple(successors))
+            self.canonical.append(canonical_ids.setdefault(
+                    canonical_position(xbits, obits), len(canonical_ids)))
+            i += 1
+        self.num_canonical = len(canonical_ids)
+
+    def _add(self, xbits, obits):
+        self.index[xbits, obits] = len(self.positions)
+        self.positions.append((xbits, obits))
+        self.features.append(line_features(xbits, obits))
+        winner = line_winner(xbits, obits)
+        if winner == E and xbits | obits != FULL_BOARD:
+            winner = None
+        self.outcomes.append(winner)
+
+    @classmethod
+    def load(cls, path):
+        """Loads the table cached at path, building and caching it if the
+        cache is missing or was built for different STATE_COMPONENTS.
+
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'states.pickle')
+        >>> StateTable.load(path).num_canonical, os.path.exists(path)
+        (765, True)
+        >>> StateTable.load(path).num_canonical
+        765
+
+        """
+        try:
+            with open(path, 'rb') as cache:
+                components, table = cPickle.load(cache)
+            if components == STATE_COMPONENTS:
+                return table
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            pass
+        table = cls()
+        with open(path, 'wb') as cache:
+            cPickle.dump((STATE_COMPONENTS, table), cache,
+                         cPickle.HIGHEST_PROTOCOL)
+        return table
+
+
+_state_table = None
+
+def state_table(cache_path=None):
+    """Returns the process-wide StateTable, loading it from cache_path if
+    one is given."""
+    global _state_table
+    if _state_table is None:
+        _state_table = (StateTable.load(cache_path) if cache_path
+                        else StateTable())
+    return _state_table
+
+
 class StateChart(object):
-    def __init__(self, iterations, cycles):
-        self.states = {}
-        for it in xrange(iterations):
-            for cycle in xrange(cycles):
-                if cycle % 10 == 0:
-                    print >> sys.stdout, "{it:>2}: {cycle:>3}\r".format(
-                            it=it, cycle=cycle),
-                    sys.stdout.flush()
-            self.update_probabilities()
+    def __init__(self, iterations, cycles, processes=None, geometry=None,
+                 table_cache=None):
+        """Trains by playing iterations rounds of cycles self-play games.
+
+        The games of a round are spread over a pool of processes (one per
+        CPU unless processes says otherwise). Every game of a round sees the
+        probabilities from the end of the previous round. geometry picks the
+        board to play on and defaults to tic-tac-toe. table_cache is a file
+        to cache the StateTable in (see StateTable.load).
+
+        """
+        self.geometry = geometry or TIC_TAC_TOE
+        self.table_cache = table_cache
+        # Feature tuples are numbered densely. Row i of the arrays below
+        # belongs to features[i].
+        self.ids = {}
+        self.features = []
+        self.counts = np.zeros((64, len(WINNERS)), dtype=np.int64)
+        self.players = np.zeros(64, dtype=np.int8)
+        self.win_probs = np.full(64, 0.5)
+        if not iterations * cycles:
+            return
+        if self.geometry is TIC_TAC_TOE:
+            # Loaded before the pool forks, so its workers have it already.
+            state_table(table_cache)
+
+        pool = None
+        if processes != 1:
+            # Forked workers would otherwise all play the same games.
+            pool = multiprocessing.Pool(processes, initializer=random.seed)
+        try:
+            for it in xrange(iterations):
+                self.train(cycles, pool, it)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def train(self, games, pool=None, it=0):
+        """Plays games against the current probabilities, then updates them."""
+        tasks = [(self, min(GAMES_PER_TASK, games - start))
+                 for start in xrange(0, games, GAMES_PER_TASK)]
+        results = pool.imap(play_games, tasks) if pool else (
+                play_games(task) for task in tasks)
+        played = 0
+        for (_, task_games), deltas in zip(tasks, results):
+            self.merge_counts(deltas)
+            played += task_games
+            print >> sys.stdout, "{it:>2}: {cycle:>3}\r".format(
+                    it=it, cycle=played),
+            sys.stdout.flush()
+        self.update_probabilities()
 
     def get_prob(self, state):
         if isinstance(state, dict):
             state = StateChart.state_dict_to_tuple(state)
-        if state not in self.states:
+        state_id = self.ids.get(state)
+        if state_id is None:
             return 0.5
         else:
-            return self.states[state]['win_prob']
+            return self.win_probs[state_id]
+
+    def _state_id(self, state, player):
+        state_id = self.ids.get(state)
+        if state_id is None:
+            state_id = self.ids[state] = len(self.features)
+            self.features.append(state)
+            if state_id == len(self.players):
+                self._grow()
+            self.players[state_id] = PLAYERS.index(player)
+        return state_id
+
+    def _grow(self):
+        capacity = max(64, 2 * len(self.players))
+        counts = np.zeros((capacity, len(WINNERS)), dtype=np.int64)
+        counts[:len(self.counts)] = self.counts
+        players = np.zeros(capacity, dtype=np.int8)
+        players[:len(self.players)] = self.players
+        win_probs = np.full(capacity, 0.5)
+        win_probs[:len(self.win_probs)] = self.win_probs
+        self.counts, self.players, self.win_probs = counts, players, win_probs
 
     def state_seen(self, state, player, winner):
         if isinstance(state, dict):
             state = StateChart.state_dict_to_tuple(state)
-        if state not in self.states:
-            self.states[state] = {
-                    'player': player, 'win_prob': 0.5, X: 0, O: 0, E: 0}
-        self.states[state][winner] += 1
+        # _state_id may grow the arrays, so it must run before self.counts
+        # is looked up.
+        state_id = self._state_id(state, player)
+        self.counts[state_id, WINNERS.index(winner)] += 1
+
+    @property
+    def states(self):
+        """A {state: {'player', 'win_prob', X, O, E}} snapshot of the chart."""
+        states = {}
+        for state_id, state in enumerate(self.features):
+            state_info = dict(zip(WINNERS, self.counts[state_id].tolist()))
+            state_info['player'] = PLAYERS[self.players[state_id]]
+            state_info['win_prob'] = float(self.win_probs[state_id])
+            states[state] = state_info
+        return states
+
+    def counts_by_state(self):
+        """Returns the {state: {'player', X, O, E}} counts seen so far."""
+        deltas = {}
+        for state_id, state in enumerate(self.features):
+            delta = dict(zip(WINNERS, self.counts[state_id].tolist()))
+            delta['player'] = PLAYERS[self.players[state_id]]
+            deltas[state] = delta
+        return deltas
+
+    def merge_counts(self, deltas):
+        """Adds counts in the format returned by counts_by_state()."""
+        for state, delta in deltas.items():
+            state_id = self._state_id(state, delta['player'])
+            self.counts[state_id] += [delta[winner] for winner in WINNERS]
 
     def update_probabilities(self):
-        for state_info in self.states.values():
-            wins = float(state_info[state_info['player']])
-            total = state_info[X] + state_info[O] + state_info[E]
-            state_info['win_prob'] = wins / total
+        n = len(self.features)
+        counts = self.counts[:n]
+        wins = counts[np.arange(n), self.players[:n]]
+        totals = counts.sum(axis=1)
+        np.true_divide(wins, totals, out=self.win_probs[:n], where=totals > 0)
 
     def clear_history(self):
-        for state_info in self.states.values():
-            state_info['wins'] = 0
-            state_info['losses'] = 0
+        self.counts[:] = 0
+
+    def save(self, path):
+        """Saves the chart as an .npz archive."""
+        n = len(self.features)
+        np.savez(path,
+                 geometry=[self.geometry.rows, self.geometry.cols,
+                           self.geometry.k],
+                 features=np.array(self.features, dtype=np.int32).reshape(
+                         n, len(self.geometry.components)),
+                 counts=self.counts[:n], players=self.players[:n],
+                 win_probs=self.win_probs[:n])
+
+    @classmethod
+    def load(cls, path):
+        """Loads a chart written by save()."""
+        with np.load(path) as archive:
+            state_chart = cls(0, 0, geometry=geometry(
+                    *archive['geometry'].tolist()))
+            state_chart.features = [tuple(row) for row in
+                                    archive['features'].tolist()]
+            state_chart.counts = archive['counts']
+            state_chart.players = archive['players']
+            state_chart.win_probs = archive['win_probs']
+        state_chart.ids = {state: state_id for state_id, state
+                           in enumerate(state_chart.features)}
+        return state_chart
 
     @staticmethod
     def state_dict_to_tuple(state_dict):
@@ -74,69 +429,85 @@ class StateChart(object):
 
 
 class Board(object):
-    def __init__(self, state_chart, predefine=None):
+    def __init__(self, state_chart, predefine=None, geometry=None):
         self.state_chart = state_chart
-        self.board = {(r, c): E for r in range(3) for c in range(3)}
+        self.geometry = geometry or TIC_TAC_TOE
+        self.bits = {X: 0, O: 0}
+        # The X and O counts of every line and the feature tuple (as a list)
+        # are kept up to date by each move, so only the lines through the
+        # moved square are ever looked at.
+        self.line_counts = {X: [0] * len(self.geometry.line_masks),
+                            O: [0] * len(self.geometry.line_masks)}
+        self.features = [0] * len(self.geometry.components)
+        self.features[self.geometry.line_feature[0][0]] = len(
+                self.geometry.line_masks)
         self.player = X
         if predefine:
-            self.player = X
-            for a in range(3):
-                for b in range(3):
-                    self.board[a, b] = predefine[3 * a + b]
-                    if self.board[a, b] != E:
-                        self.player = X if self.player == O else O
+            for square, mark in enumerate(
+                    predefine[:self.geometry.num_squares]):
+                if mark != E:
+                    self._place(square, X if mark == X else O)
+                    self.player = X if self.player == O else O
         self.moves = []
+        # Tic-tac-toe positions in the StateTable are answered by lookups.
+        # Anything else (e.g. an unreachable predefine) uses the features.
+        self.table = None
+        self.index = None
+        if self.geometry is TIC_TAC_TOE:
+            self.table = state_table(state_chart.table_cache
+                                     if state_chart else None)
+            self.index = self.table.index.get((self.bits[X], self.bits[O]))
+        self.indices = []
 
     def copy(self):
         pass
 
-    def at(self, spot):
-        return self.board[spot.row, spot.col]
+    def _place(self, square, player, step=1):
+        """Adds (or with step=-1 removes) player's mark on square."""
+        self.bits[player] ^= 1 << square
+        counts = self.line_counts[player]
+        x_counts, o_counts = self.line_counts[X], self.line_counts[O]
+        line_feature = self.geometry.line_feature
+        features = self.features
+        for line in self.geometry.lines_through[square]:
+            features[line_feature[x_counts[line]][o_counts[line]]] -= 1
+            counts[line] += step
+            features[line_feature[x_counts[line]][o_counts[line]]] += 1
 
-    def state(self):
-        # Since these represent states, we need to be able to account for
-        # the case where we have a win. Furthermore, the total number of
-        # entries in a trio cannot exceed 3.
-        s = {state: 0 for state in STATE_COMPONENTS}
-
-        # Account rows
-        for c in range(3):
-            s[Board.identify_trio(
-                    tuple(self.board[r, c] for r in range(3)))] += 1
-
-        # Account cols
-        for r in range(3):
-            s[Board.identify_trio(
-                    tuple(self.board[r, c] for c in range(3)))] += 1
-
-        # Account down diagonal
-        s[Board.identify_trio(
-                tuple(self.board[x, x] for x in range(3)))] += 1
+    def _mark(self, square):
+        if self.bits[X] >> square & 1:
+            return X
+        elif self.bits[O] >> square & 1:
+            return O
+        return E
 
-        # Account up diagonal
-        s[Board.identify_trio(
-                tuple(self.board[2 - x, x] for x in range(3)))] += 1
+    def at(self, spot):
+        return self._mark(self.geometry.cols * spot.row + spot.col)
 
-        return s
+    def state(self):
+        if self.index is not None:
+            return self.table.features[self.index]
+        return tuple(self.features)
 
     def get_next_states_probs(self):
         """Returns lose_prob for the next player at each adjacent state."""
         next_states = {}
-        # This is changed in self.move
-        true_next_player = self.player
-     #  print 'next:', true_next_player
-        for coords in [(r, c) for r in range(3) for c in range(3)]:
-            spot = Spot(*coords)
-            if self.at(spot) == E:
-            #   print 'NEXT:', self.player
-                self.move(spot)
-                next_states[spot] = self.state_chart.get_prob(self.state())
-            #   print self
-            #   print next_states[spot]
-            #   raw_input()
-                self.board[spot.row, spot.col] = E
-                self.moves.pop()
-                self.player = true_next_player
+        if self.index is not None:
+            features = self.table.features
+            successors = self.table.successors[self.index]
+            for square, successor in enumerate(successors):
+                if successor >= 0:
+                    next_states[SPOTS[square]] = self.state_chart.get_prob(
+                            features[successor])
+            return next_states
+
+        taken = self.bits[X] | self.bits[O]
+        for square, spot in enumerate(self.geometry.spots):
+            if not taken >> square & 1:
+                self._place(square, self.player)
+                next_states[spot] = self.state_chart.get_prob(
+                        tuple(self.features))
+                self._place(square, self.player, step=-1)
         return next_states
 
     def get_weighted_move(self):
@@ -151,9 +522,14 @@ class Board(object):
         assert False, "No move picked by get_weighted_move()"
 
     def move(self, spot):
-        if self.board[spot.row, spot.col] == E:
-            self.board[spot.row, spot.col] = self.player
+        square = self.geometry.cols * spot.row + spot.col
+        if not (self.bits[X] | self.bits[O]) >> square & 1:
+            self._place(square, self.player)
             self.moves.append(spot)
+            self.indices.append(self.index)
+            if self.index is not None:
+                successor = self.table.successors[self.index][square]
+                self.index = successor if successor >= 0 else None
 
             if self.player == X:
                 self.player = O
@@ -162,51 +538,479 @@ class Board(object):
         else:
             assert False, "Illegal move attempted."
 
+    def undo(self):
+        spot = self.moves.pop()
+        self.index = self.indices.pop()
+        self.player = X if self.player == O else O
+        self._place(self.geometry.cols * spot.row + spot.col, self.player,
+                    step=-1)
+
     def game_is_over(self):
-        s = self.state()
-        if self.board.values().count(E) == 0 or s[3, 0] >= 1 or s[0, 3] >= 1:
+        if self.index is not None:
+            return self.table.outcomes[self.index] is not None
+        if (self.bits[X] | self.bits[O] == self.geometry.full
+                or self.winner() != E):
             return True
         return False
 
     def winner(self):
-        s = self.state()
-        if s[3, 0] >= 1:
+        if self.index is not None:
+            return self.table.outcomes[self.index] or E
+        if self.features[self.geometry.x_wins]:
             return X
-        elif s[0, 3] >= 1:
+        elif self.features[self.geometry.o_wins]:
             return O
-        else:
-            return E
+        return E
 
     def __str__(self):
+        cols = self.geometry.cols
         row_to_str = lambda row: "|".join(
-                ["{0:>2}".format(self.board[row, c]) for c in range(3)])
-        return "\n--+--+--\n".join(row_to_str(r) for r in range(3))
+                ["{0:>2}".format(self._mark(cols * row + c))
+                 for c in range(cols)])
+        return ("\n" + "+".join(["--"] * cols) + "\n").join(
+                row_to_str(r) for r in range(self.geometry.rows))
 
-    @staticmethod
-    def identify_trio(trio):
-        ident = trio.count(X), trio.count(O)
-        return ident if ident in STATE_COMPONENTS else None
+def iteration(state_chart, recorder=None):
+    """Plays a game using state_chart and records it in recorder.
 
-def iteration(state_chart):
-    board = Board(state_chart)
+    recorder defaults to state_chart.
+
+    """
+    if recorder is None:
+        recorder = state_chart
+    board = Board(state_chart, geometry=state_chart.geometry)
     while not board.game_is_over():
         board.move(board.get_weighted_move())
 
     winner = board.winner()
     if winner != E:
-        replay_board = Board(None)
+        replay_board = Board(None, geometry=state_chart.geometry)
         # Now update the win/loss counts.
         for spot in board.moves:
             replay_board.move(spot)
-            state_chart.state_seen(
+            recorder.state_seen(
                     replay_board.state(), replay_board.player, winner)
     return winner
 
-def interactive(human, state_chart):
+class BatchSimulator(object):
+    """Plays many self-play games at once.
+
+    Every game is a StateTable index, so a whole batch advances with a few
+    array operations per ply. Moves are drawn with the same weighting as
+    Board.get_weighted_move and the positions each game visits are recorded
+    as it is played, so no replay is needed to credit them.
+
+    """
+    def __init__(self, table=None, rng=None):
+        table = table or state_table()
+        self.rng = rng or np.random.RandomState()
+        self.successors = np.array(table.successors, dtype=np.int32)
+        # -1 while the game goes on, else the WINNERS column of the outcome.
+        self.outcomes = np.array(
+                [-1 if outcome is None else WINNERS.index(outcome)
+                 for outcome in table.outcomes], dtype=np.int8)
+        # The PLAYERS column of whoever moves next in each position.
+        self.players = np.array(
+                [0 if POPCOUNT[xbits] == POPCOUNT[obits] else 1
+                 for xbits, obits in table.positions], dtype=np.int8)
+        # Positions share feature tuples, so they are numbered once here.
+        feature_ids = {}
+        self.feature_ids = np.array(
+                [feature_ids.setdefault(features, len(feature_ids))
+                 for features in table.features], dtype=np.int32)
+        self.features = sorted(feature_ids, key=feature_ids.get)
+
+    def play(self, state_chart, games, recorder=None):
+        """Plays games using state_chart and records them in recorder.
+
+        recorder defaults to state_chart. Returns the WINNERS column of
+        each game's winner.
+
+        """
+        if recorder is None:
+            recorder = state_chart
+        probs = np.array([state_chart.get_prob(features)
+                          for features in self.features])[self.feature_ids]
+
+        positions = np.zeros(games, dtype=np.int32)
+        history = np.full((games, 9), -1, dtype=np.int32)
+        active = np.arange(games)
+        for ply in xrange(9):
+            candidates = self.successors[positions[active]]
+            legal = candidates >= 0
+            weights = np.where(legal, probs[candidates], 0.0)
+            # get_weighted_move picks the first legal square when nothing
+            # has any weight. Picking uniformly is kinder.
+            stuck = weights.sum(axis=1) == 0
+            weights[stuck] = legal[stuck]
+            cdf = np.cumsum(weights, axis=1)
+            draws = self.rng.random_sample(len(active)) * cdf[:, -1]
+            choices = (cdf <= draws[:, np.newaxis]).sum(axis=1)
+            moved = candidates[np.arange(len(active)), choices]
+            positions[active] = moved
+            history[active, ply] = moved
+            active = active[self.outcomes[moved] < 0]
+            if not len(active):
+                break
+
+        winners = self.outcomes[positions]
+        self._record(recorder, history, winners)
+        return winners
+
+    def _record(self, recorder, history, winners):
+        # Like iteration(), only decisive games are credited.
+        decisive = winners != WINNERS.index(E)
+        visited = history[decisive]
+        seen = visited >= 0
+        positions = visited[seen]
+        if not len(positions):
+            return
+        winner_columns = np.repeat(winners[decisive], seen.sum(axis=1))
+        feature_ids = self.feature_ids[positions]
+
+        counts = np.bincount(
+                feature_ids * len(WINNERS) + winner_columns,
+                minlength=len(self.features) * len(WINNERS)).reshape(
+                        len(self.features), len(WINNERS))
+        # Register new states in the order the games first saw them, along
+        # with the player that was to move then.
+        unique_ids, first_seen = np.unique(feature_ids, return_index=True)
+        for feature_id, index in sorted(zip(unique_ids, first_seen),
+                                        key=lambda pair: pair[1]):
+            state_id = recorder._state_id(
+                    self.features[feature_id],
+                    PLAYERS[self.players[positions[index]]])
+            recorder.counts[state_id] += counts[feature_id]
+
+def play_games(task):
+    """Worker for StateChart.train.
+
+    task is a (state_chart, games) pair. Returns the count deltas of the
+    games.
+
+    """
+    state_chart, games = task
+    recorder = StateChart(0, 0, geometry=state_chart.geometry)
+    if state_chart.geometry is TIC_TAC_TOE:
+        BatchSimulator(state_table(state_chart.table_cache)).play(
+                state_chart, games, recorder)
+    else:
+        for _ in xrange(games):
+            iteration(state_chart, recorder)
+    return recorder.counts_by_state()
+
+# Solver scores. A win is worth WIN plus the number of squares that were
+# empty before the winning move, so quicker wins score higher. Heuristic
+# scores stay well below WIN.
+WIN = 1 << 20
+
+# Transposition table entry flags: the stored value is exact, a lower bound
+# or an upper bound.
+EXACT, LOWER, UPPER = range(3)
+
+
+class _OutOfTime(Exception):
+    pass
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+class Solver(object):
+    """Finds the game-theoretic value of positions by negamax search with
+    alpha-beta pruning.
+
+    Searched positions are remembered in a transposition table keyed by
+    their Zobrist hash and holding up to table_size entries, the least
+    recently used of which are dropped first. On tic-tac-toe, positions in
+    the StateTable are keyed by their class under the board symmetries
+    instead, so the 8 rotations and reflections of a position share one
+    entry. Boards too big to search to the end are searched by iterative
+    deepening, scoring the positions where the search stops by how many open
+    lines each side has.
+
+    >>> solver = Solver()
+    >>> solver.outcome(0, 0) == E
+    True
+    >>> solver.outcome(0b000000011, 0b000011000) == X
+    True
+
+    Its moves keep the perfect play result of every position, even when the
+    table is full of earlier searches:
+
+    >>> table = state_table()
+    >>> outcomes = perfect_outcomes(table)
+    >>> unfinished = [i for i, outcome in enumerate(table.outcomes)
+    ...               if outcome is None]
+    >>> all(solver.outcome(*table.positions[i]) == outcomes[i]
+    ...     for i in unfinished)
+    True
+    >>> all(outcomes[table.successors[i][solver.solve(*table.positions[i])[1]]]
+    ...     == outcomes[i] for i in unfinished)
+    True
+
+    """
+    def __init__(self, geometry=None, table_size=1 << 20, seed=0):
+        self.geometry = geometry or TIC_TAC_TOE
+        rand = random.Random(seed)
+        # zobrist[player][square] is xored into the hash of any position
+        # with player's mark on square. Whose turn it is follows from the
+        # marks, so it needs no key of its own.
+        self.zobrist = tuple(
+                tuple(rand.getrandbits(64)
+                      for _ in range(self.geometry.num_squares))
+                for _ in PLAYERS)
+        self.table = OrderedDict()
+        self.table_size = table_size
+        self.states = state_table() if self.geometry is TIC_TAC_TOE else None
+        # Squares on the most lines are tried first, as they prune the most.
+        self.order = sorted(range(self.geometry.num_squares),
+                            key=lambda square: -len(
+                                    self.geometry.lines_through[square]))
+        self.nodes = 0
+        self.deadline = None
+
+    def _lookup(self, key):
+        entry = self.table.pop(key, None)
+        if entry is not None:
+            # Back to the most recently used end.
+            self.table[key] = entry
+        return entry
+
+    def _store(self, key, entry):
+        self.table.pop(key, None)
+        self.table[key] = entry
+        if len(self.table) > self.table_size:
+            self.table.popitem(last=False)
+
+    def _hash(self, xbits, obits):
+        key = 0
+        for player, bits in enumerate((xbits, obits)):
+            for square in range(self.geometry.num_squares):
+                if bits >> square & 1:
+                    key ^= self.zobrist[player][square]
+        return key
+
+    def _key(self, own, opp, player, key):
+        # Zobrist hashes are never negative, so symmetry classes are
+        # numbered below zero to keep the two apart.
+        if self.states is not None:
+            i = self.states.index.get((own, opp) if player == 0
+                                      else (opp, own))
+            if i is not None:
+                return -1 - self.states.canonical[i]
+        return key
+
+    def _heuristic(self, own, opp):
+        score = 0
+        for mask in self.geometry.line_masks:
+            if not opp & mask:
+                score += _popcount(own & mask) ** 2
+            elif not own & mask:
+                score -= _popcount(opp & mask) ** 2
+        return score
+
+    def _negamax(self, own, opp, player, key, depth, alpha, beta,
+                 root=False):
+        """Returns the value of the position for the player to move, whose
+        marks are own, searching depth moves ahead, and the best square to
+        play (None if the value came straight from the table or the
+        heuristic). At the root the table only orders the moves, so the
+        square returned is always one that was searched. key is the Zobrist
+        hash of the position."""
+        self.nodes += 1
+        if (self.deadline is not None and not self.nodes & 1023
+                and time.time() > self.deadline):
+            raise _OutOfTime()
+        taken = own | opp
+        empties = self.geometry.num_squares - _popcount(taken)
+        if not empties:
+            return 0, None
+        # Searching past the last move changes nothing, so a search to
+        # depth empties is exact and can answer any deeper one.
+        depth = min(depth, empties)
+
+        best_square = None
+        table_key = self._key(own, opp, player, key)
+        entry = self._lookup(table_key)
+        if entry is not None:
+            entry_depth, value, flag, best_square = entry
+            if entry_depth >= depth and not root:
+                if flag == EXACT:
+                    return value, None
+                elif flag == LOWER:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value, None
+            # The entry may be for a rotation or reflection of this
+            # position, whose best square can be taken here.
+            if best_square is not None and taken >> best_square & 1:
+                best_square = None
+        if not depth:
+            return self._heuristic(own, opp), None
+        # The window the search below runs with, which the stored flag must
+        # describe.
+        original_alpha = alpha
+
+        squares = [square for square in self.order if not taken >> square & 1]
+        if best_square is not None:
+            squares.remove(best_square)
+            squares.insert(0, best_square)
+        line_masks = self.geometry.line_masks
+        best = -2 * WIN
+        for square in squares:
+            mine = own | 1 << square
+            if any(mine & line_masks[line] == line_masks[line]
+                   for line in self.geometry.lines_through[square]):
+                value = WIN + empties
+            else:
+                value = -self._negamax(
+                        opp, mine, 1 - player,
+                        key ^ self.zobrist[player][square], depth - 1,
+                        -beta, -alpha)[0]
+            if value > best:
+                best, best_square = value, square
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if best <= original_alpha:
+            flag = UPPER
+        elif best >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self._store(table_key, (depth, best, flag, best_square))
+        return best, best_square
+
+    def solve(self, xbits, obits, max_depth=None, seconds=None):
+        """Searches the position for the player to move.
+
+        Searches 1, 2, ... moves ahead until a win or loss is proven,
+        max_depth (by default the end of the game) is reached or seconds run
+        out, and keeps the deepest finished search. The shallow searches are
+        cheap, and order the moves of the deeper ones through the table.
+        Returns (value, square, depth): the value for the player to move
+        (above WIN means a win, below -WIN a loss, 0 from a search to the
+        end a draw), the best square to play and how deep the search went.
+
+        """
+        if (line_winner(xbits, obits, self.geometry) != E
+                or xbits | obits == self.geometry.full):
+            raise ValueError("The game is over.")
+        player = 0 if _popcount(xbits) == _popcount(obits) else 1
+        own, opp = (xbits, obits) if player == 0 else (obits, xbits)
+        key = self._hash(xbits, obits)
+        empties = self.geometry.num_squares - _popcount(xbits | obits)
+        max_depth = min(max_depth or empties, empties)
+
+        self.deadline = None if seconds is None else time.time() + seconds
+        result = None
+        try:
+            for depth in range(1, max_depth + 1):
+                value, square = self._negamax(own, opp, player, key, depth,
+                                              -2 * WIN, 2 * WIN, root=True)
+                result = (value, square, depth)
+                if abs(value) > WIN:
+                    break
+        except _OutOfTime:
+            if result is None:
+                raise ValueError("Not even one move could be searched in "
+                                 "{0} seconds.".format(seconds))
+        finally:
+            self.deadline = None
+        return result
+
+    def outcome(self, xbits, obits):
+        """Returns who wins the position with perfect play (E for a draw).
+
+        Only exact on boards small enough to search to the end.
+
+        """
+        winner = line_winner(xbits, obits, self.geometry)
+        if winner != E or xbits | obits == self.geometry.full:
+            return winner
+        value = self.solve(xbits, obits)[0]
+        x_to_move = _popcount(xbits) == _popcount(obits)
+        if value > WIN:
+            return X if x_to_move else O
+        elif value < -WIN:
+            return O if x_to_move else X
+        return E
+
+    def best_move(self, board, seconds=None):
+        """Returns the Spot the player to move on board should play."""
+        square = self.solve(board.bits[X], board.bits[O],
+                            seconds=seconds)[1]
+        return board.geometry.spots[square]
+
+
+def perfect_outcomes(table=None):
+    """Returns who wins each StateTable position with perfect play (E for a
+    draw), worked out backwards through the table rather than searched."""
+    table = table or state_table()
+    outcomes = list(table.outcomes)
+    # Successors always come later in the table.
+    for i in reversed(range(len(outcomes))):
+        if outcomes[i] is not None:
+            continue
+        xbits, obits = table.positions[i]
+        mover, other = (X, O) if POPCOUNT[xbits] == POPCOUNT[obits] else (O, X)
+        results = set(outcomes[successor]
+                      for successor in table.successors[i] if successor >= 0)
+        outcomes[i] = (mover if mover in results
+                       else E if E in results else other)
+    return outcomes
+
+
+def evaluate_chart(state_chart, solver=None):
+    """Returns the fraction of unfinished tic-tac-toe positions in which the
+    move state_chart rates best is a perfect play move.
+
+    >>> solver = Solver()
+    >>> untrained = evaluate_chart(StateChart(0, 0), solver)
+    >>> chart = StateChart(3, 20000, processes=1)  # doctest: +ELLIPSIS
+     0: ...
+    >>> trained = evaluate_chart(chart, solver)
+    >>> trained > 0.75, trained > untrained + 0.1
+    (True, True)
+
+    """
+    solver = solver or Solver()
+    table = state_table()
+    correct = total = 0
+    for i, (xbits, obits) in enumerate(table.positions):
+        if table.outcomes[i] is not None:
+            continue
+        mover = X if POPCOUNT[xbits] == POPCOUNT[obits] else O
+        # How each move ends for the mover: 1 win, 0 draw, -1 loss.
+        results = {}
+        probs = {}
+        for square, successor in enumerate(table.successors[i]):
+            if successor < 0:
+                continue
+            winner = solver.outcome(*table.positions[successor])
+            results[square] = 0 if winner == E else (
+                    1 if winner == mover else -1)
+            probs[square] = state_chart.get_prob(table.features[successor])
+        # get_prob is the win probability of the player to move next, which
+        # after this move is the opponent.
+        chart_pick = min(probs, key=probs.get)
+        correct += results[chart_pick] == max(results.values())
+        total += 1
+    return float(correct) / total
+
+
+def interactive(human, state_chart, solver=None):
+    """Plays human against the AI, which plays perfectly if given a solver
+    and by state_chart otherwise."""
     pprint({k: v for k, v in state_chart.states.items()})
-    board = Board(state_chart)
+    board = Board(state_chart, geometry=state_chart.geometry)
     while not board.game_is_over():
-        print board.player, StateChart.state_dict_to_tuple(board.state()), state_chart.get_prob(board.state())
+        print board.player, board.state(), state_chart.get_prob(board.state())
         if board.player == human:
             print
             print "HUMAN"
@@ -226,7 +1030,10 @@ def interactive(human, state_chart):
             print "Next state lose probs (for human player)"
             pprint({str(k): v for k, v in next_states_win_probs.items()})
             print "total win_probs:", total
-            board.move(board.get_weighted_move())
+            if solver:
+                board.move(solver.best_move(board))
+            else:
+                board.move(board.get_weighted_move())
 
     print "Game over!"
     print board
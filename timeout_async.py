@@ -0,0 +1,48 @@
+"""The asyncio half of timeout.py. It needs Python 3."""
+
+import asyncio
+
+import timeout
+
+
+async def _wait(awaitable, budget):
+    """Awaits awaitable for at most budget seconds and returns True if it
+    ran out of time, else False along with its result."""
+    if hasattr(asyncio, 'timeout'):
+        try:
+            async with asyncio.timeout(budget) as scope:
+                return False, await awaitable
+        except TimeoutError:
+            if scope.expired():
+                return True, None
+            raise
+    try:
+        return False, await asyncio.wait_for(awaitable, budget)
+    except asyncio.TimeoutError:
+        return True, None
+
+
+def timeout_coroutine_function(func, seconds, metrics):
+    """Returns a coroutine function that awaits func for at most seconds,
+    or for whatever is left of an enclosing deadline if that is sooner."""
+    name = "{0}.{1}".format(
+            func.__module__, getattr(func, '__qualname__', func.__name__))
+    async def wrapped(*args, **kwargs):
+        start = timeout._now()
+        budget, deadline = timeout._budget(seconds)
+        timed_out = not budget
+        if not timed_out:
+            token = timeout._deadline.set(deadline)
+            try:
+                timed_out, value = await _wait(func(*args, **kwargs), budget)
+            except Exception:
+                metrics.observe(timeout._now() - start, error=True)
+                raise
+            finally:
+                timeout._deadline.reset(token)
+        elapsed = timeout._now() - start
+        metrics.observe(elapsed, timed_out=timed_out)
+        if timed_out:
+            raise timeout.TimeoutError(name, seconds, elapsed)
+        return value
+    return wrapped
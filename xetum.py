@@ -1,33 +1,125 @@
+from __future__ import print_function
+
 import threading
 import copy
+import multiprocessing
+import pickle
+import random
+import struct
+import sys
 import time
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8.
+    shared_memory = None
+
 class XetumWriteException(Exception):
     pass
 
 
+# Snapshot strategies. A Xetum commits snapshot(new_value) rather than
+# new_value itself, so that a writer can't change the committed value after the
+# fact by mutating its own copy.
+deep_snapshot = copy.deepcopy
+
+
+shallow_snapshot = copy.copy
+
+
+def shared_snapshot(value):
+    """Commits the value itself. Use this for immutable or persistent values
+    (tuples, frozensets, strings, structures that share unchanged parts between
+    versions), which don't need copying at all."""
+    return value
+
+
+def exponential_backoff(base=0.0005, cap=0.05):
+    """Returns a backoff for Xetum.transact that sleeps a random time of up to
+    base * 2 ** conflicts seconds, but never more than cap. The randomness
+    keeps writers that conflicted together from retrying together."""
+    def backoff(conflicts):
+        time.sleep(random.uniform(0, min(cap, base * 2 ** conflicts)))
+    return backoff
+
+
+class XetumStats(object):
+    """Counts what Xetum.transact had to do to commit."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Transactions committed.
+        self.commits = 0
+        # Optimistic commits that failed because of a version mismatch.
+        self.conflicts = 0
+        # Transactions that gave up on optimism and took the lock.
+        self.escalations = 0
+        # Transactions that raised after running out of retries.
+        self.failures = 0
+
+    def count(self, commits=0, conflicts=0, escalations=0, failures=0):
+        with self.lock:
+            self.commits += commits
+            self.conflicts += conflicts
+            self.escalations += escalations
+            self.failures += failures
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'commits': self.commits,
+                'conflicts': self.conflicts,
+                'escalations': self.escalations,
+                'failures': self.failures,
+            }
+
+
 class _XetumSingleton(object):
-    def __init__(self, to_wrap):
-        self.lock = threading.Semaphore(value=1)
-        self.wrapped = to_wrap
-        self.version = 1
+    def __init__(self, to_wrap, snapshot=deep_snapshot):
+        # Only writers take the lock.
+        self.lock = threading.Lock()
+        self.snapshot = snapshot
+        # The committed value and its version. They are swapped as one tuple,
+        # and assigning an attribute is atomic, so readers always see a
+        # matching pair without locking.
+        self.state = (to_wrap, 1)
+        self.stats = XetumStats()
+
+    @property
+    def wrapped(self):
+        return self.state[0]
+
+    @property
+    def version(self):
+        return self.state[1]
 
     def read(self):
-        # The version must match the data.
-        with self.lock:
-            return self.wrapped, self.version
+        return self.state
 
     def write(self, new_value, version):
+        """Commits new_value if version is still current and returns the
+        committed value and its new version."""
+        # Fail before copying if someone has already committed over version.
+        if version != self.state[1]:
+            raise XetumWriteException()
+
         # Phase one. Prepare data.
-        wrapped_next = copy.deepcopy(new_value)
+        wrapped_next = self.snapshot(new_value)
 
         # Phase two. Commit data.
         with self.lock:
-            if version == self.version:
-                self.wrapped = wrapped_next
-                self.version += 1
-            else:
+            if version != self.state[1]:
                 raise XetumWriteException()
+            self.state = (wrapped_next, version + 1)
+            return self.state
+
+    def write_locked(self, fn):
+        """Commits fn(value) while holding the lock, so nothing can commit in
+        between. Returns the committed value and its version."""
+        with self.lock:
+            wrapped, version = self.state
+            self.state = (self.snapshot(fn(wrapped)), version + 1)
+            return self.state
 
 
 class Xetum(object):
@@ -46,16 +138,18 @@ class Xetum(object):
     and try again. The intention is to minimize the amount of time the mutex is
     locked.
 
+    Reads take no lock at all. The copy is made by snapshot, which defaults to
+    deep_snapshot. Pass shallow_snapshot if the values are never mutated below
+    their top level, or shared_snapshot if they are never mutated at all.
+
     """
-    def __init__(self, to_wrap):
+    def __init__(self, to_wrap, snapshot=deep_snapshot):
         if not isinstance(to_wrap, Xetum):
-            self.xetum_singleton = _XetumSingleton(to_wrap)
+            self.xetum_singleton = _XetumSingleton(to_wrap, snapshot)
             self.version = None
         else:
-            # The version must match the data.
-            with to_wrap.xetum_singleton.lock:
-                self.xetum_singleton = to_wrap.xetum_singleton
-                self.version = to_wrap.version
+            self.xetum_singleton = to_wrap.xetum_singleton
+            self.version = to_wrap.version
 
     @property
     def data(self):
@@ -66,6 +160,434 @@ class Xetum(object):
     def data(self, new_value):
         self.xetum_singleton.write(new_value, self.version)
 
+    @property
+    def stats(self):
+        return self.xetum_singleton.stats
+
+    def transact(self, fn, max_retries=8, backoff=exponential_backoff(),
+                 escalate=True):
+        """Replaces the value with fn(value), retrying on conflicts, and
+        returns the committed value.
+
+        fn may be called several times and must not modify its argument. After
+        each conflict, backoff(conflicts) is called. After max_retries
+        conflicts, fn is run once more while holding the commit lock, which
+        can't conflict, or, if escalate is False, XetumWriteException is
+        raised.
+
+        >>> counter = Xetum(0)
+        >>> counter.transact(lambda value: value + 1)
+        1
+        >>> counter.stats.snapshot()['commits']
+        1
+
+        """
+        self.value, self.version = _transact(
+                self.xetum_singleton.read, self.xetum_singleton.write,
+                self.xetum_singleton.write_locked, self.xetum_singleton.stats,
+                fn, max_retries, backoff, escalate)
+        return self.value
+
+
+def _transact(read, write, write_locked, stats, fn, max_retries, backoff,
+              escalate):
+    """The retry loop behind Xetum.transact and XetumDict.transact. read,
+    write and write_locked are those of the value to update."""
+    conflicts = 0
+    while conflicts <= max_retries:
+        value, version = read()
+        try:
+            state = write(fn(value), version)
+        except XetumWriteException:
+            conflicts += 1
+            if conflicts <= max_retries:
+                backoff(conflicts)
+            continue
+        stats.count(commits=1, conflicts=conflicts)
+        return state
+    if not escalate:
+        stats.count(conflicts=conflicts, failures=1)
+        raise XetumWriteException()
+    state = write_locked(fn)
+    stats.count(commits=1, conflicts=conflicts, escalations=1)
+    return state
+
+
+def _singletons_in_lock_order(xetums):
+    # Every group commit takes its locks in the same (id) order, so two
+    # groups that share Xetums can't each hold a lock the other waits for.
+    singletons = dict((id(xetum.xetum_singleton), xetum.xetum_singleton)
+                      for xetum in xetums)
+    return [singletons[key] for key in sorted(singletons)]
+
+
+def commit_group(writes):
+    """Commits several Xetums at once, or none of them.
+
+    writes is a sequence of (xetum, new_value) pairs. Each xetum must have
+    been read, and if any of them has been committed to since, nothing is
+    written and XetumWriteException is raised.
+
+    Lock-free reads of the Xetums may see some of the group committed and
+    some not. Use read_group to see all of them as of one moment.
+
+    >>> a, b = Xetum(10), Xetum(0)
+    >>> commit_group([(a, a.data - 3), (b, b.data + 3)])
+    >>> read_group([a, b])
+    [7, 3]
+
+    """
+    # As in _XetumSingleton.write, fail before copying if we can.
+    for xetum, _ in writes:
+        if xetum.version != xetum.xetum_singleton.state[1]:
+            raise XetumWriteException()
+    writes = [(xetum, xetum.xetum_singleton.snapshot(new_value))
+              for xetum, new_value in writes]
+    if len(set(id(xetum.xetum_singleton) for xetum, _ in writes)) \
+            < len(writes):
+        raise ValueError("a group can only write each Xetum once")
+    singletons = _singletons_in_lock_order(xetum for xetum, _ in writes)
+    for singleton in singletons:
+        singleton.lock.acquire()
+    try:
+        for xetum, _ in writes:
+            if xetum.version != xetum.xetum_singleton.state[1]:
+                raise XetumWriteException()
+        for xetum, wrapped_next in writes:
+            xetum.xetum_singleton.state = (wrapped_next, xetum.version + 1)
+    finally:
+        for singleton in reversed(singletons):
+            singleton.lock.release()
+
+
+def read_group(xetums):
+    """Reads several Xetums as of one moment, with no group commit half
+    done, and returns their values."""
+    singletons = _singletons_in_lock_order(xetums)
+    for singleton in singletons:
+        singleton.lock.acquire()
+    try:
+        for xetum in xetums:
+            xetum.value, xetum.version = xetum.xetum_singleton.read()
+    finally:
+        for singleton in reversed(singletons):
+            singleton.lock.release()
+    return [xetum.value for xetum in xetums]
+
+
+class _XetumBucket(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key: (value, version). Replaced entries are swapped in whole, so,
+        # as with _XetumSingleton.state, readers need no lock.
+        self.entries = {}
+
+
+class XetumDict(object):
+    """A dict shared by multiple threads, with a version per key.
+
+    Writes to different keys never conflict. The keys are spread over
+    num_buckets buckets, each with its own commit lock, so they rarely even
+    wait for each other. A key that isn't there has version 0.
+
+    >>> cache = XetumDict()
+    >>> cache.transact('hits', lambda hits: (hits or 0) + 1)
+    1
+    >>> value, version = cache.read('hits')
+    >>> cache.write('hits', value + 1, version)
+    (2, 2)
+    >>> cache['hits'], len(cache)
+    (2, 1)
+    >>> cache.write('hits', 0, version)  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    XetumWriteException
+
+    """
+    def __init__(self, items=(), num_buckets=64, snapshot=deep_snapshot):
+        self.buckets = [_XetumBucket() for _ in range(num_buckets)]
+        self.snapshot = snapshot
+        self.stats = XetumStats()
+        for key, value in dict(items).items():
+            self._bucket(key).entries[key] = (snapshot(value), 1)
+
+    def _bucket(self, key):
+        return self.buckets[hash(key) % len(self.buckets)]
+
+    def read(self, key, default=None):
+        """Returns the value of key, or default, and its version."""
+        return self._bucket(key).entries.get(key, (default, 0))
+
+    def __getitem__(self, key):
+        value, version = self.read(key)
+        if not version:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self._bucket(key).entries
+
+    def __len__(self):
+        return sum(len(bucket.entries) for bucket in self.buckets)
+
+    def keys(self):
+        return [key for bucket in self.buckets
+                for key in list(bucket.entries)]
+
+    def write(self, key, new_value, version):
+        """Commits new_value to key if version is still current and returns
+        the committed value and its new version."""
+        bucket = self._bucket(key)
+        if version != bucket.entries.get(key, (None, 0))[1]:
+            raise XetumWriteException()
+        wrapped_next = self.snapshot(new_value)
+        with bucket.lock:
+            if version != bucket.entries.get(key, (None, 0))[1]:
+                raise XetumWriteException()
+            bucket.entries[key] = (wrapped_next, version + 1)
+            return bucket.entries[key]
+
+    def transact(self, key, fn, max_retries=8, backoff=exponential_backoff(),
+                 escalate=True):
+        """Like Xetum.transact, for the value of key. fn gets None if the key
+        isn't there."""
+        bucket = self._bucket(key)
+        def write_locked(fn):
+            with bucket.lock:
+                value, version = bucket.entries.get(key, (None, 0))
+                state = (self.snapshot(fn(value)), version + 1)
+                bucket.entries[key] = state
+                return state
+        def write(new_value, version):
+            return self.write(key, new_value, version)
+        return _transact(lambda: self.read(key), write, write_locked,
+                         self.stats, fn, max_retries, backoff, escalate)[0]
+
+# The layout of a SharedXetum's shared memory: a header, then two buffers,
+# each with its own header. The committed value is in buffer active. Writers
+# fill the other one and then flip active, so readers of the committed value
+# are never disturbed by the next commit.
+_HEADER = struct.Struct('<QQ')                  # version, active
+_BUFFER_HEADER = struct.Struct('<QQQQ')         # seq, version, length, kind
+_PICKLED, _RAW = 0, 1
+
+
+class SharedXetum(object):
+    """A Xetum shared by multiple processes. It needs Python 3.8.
+
+    The value is pickled into shared memory that can hold up to capacity
+    bytes, except bytes, bytearrays and other buffers, which are stored as is
+    and can be read without copying through read_view. The version is in
+    shared memory too and commits are serialized by a multiprocessing.Lock,
+    so processes can compute their next values in parallel, on as many cores,
+    and commit them with the same two phase write as Xetum.
+
+    Pass the SharedXetum to the processes that use it as a Process argument.
+    Each of them has its own data, version and stats, like a Xetum made from
+    another Xetum. The process that made it should unlink() it once all of
+    them are done. If the processes come from a multiprocessing context other
+    than the default, pass it as context.
+
+    Each buffer is guarded by a sequence number that is odd while it's being
+    written, and readers retry if it was odd or changed while they read,
+    which is how reads stay lock-free.
+
+    """
+    def __init__(self, to_wrap, capacity=1 << 16, context=None):
+        if shared_memory is None:
+            raise RuntimeError("SharedXetum needs multiprocessing.shared_memory"
+                               " (Python 3.8 or later)")
+        self.capacity = capacity
+        # Serialized first, so a value that doesn't fit leaks no memory.
+        kind, payload = self._serialize(to_wrap)
+        self.memory = shared_memory.SharedMemory(
+                create=True,
+                size=_HEADER.size + 2 * (_BUFFER_HEADER.size + capacity))
+        self.lock = (context or multiprocessing).Lock()
+        self.stats = XetumStats()
+        self.version = None
+        self._fill(0, 1, kind, payload)
+        _HEADER.pack_into(self.memory.buf, 0, 1, 0)
+
+    def __getstate__(self):
+        return self.memory.name, self.capacity, self.lock
+
+    def __setstate__(self, state):
+        name, self.capacity, self.lock = state
+        # Processes share the resource tracker of the one that made the
+        # memory, which is already tracking it.
+        if sys.version_info >= (3, 13):
+            self.memory = shared_memory.SharedMemory(name, track=False)
+        else:
+            self.memory = shared_memory.SharedMemory(name)
+        self.stats = XetumStats()
+        self.version = None
+
+    def close(self):
+        """Unmaps the memory in this process."""
+        self.memory.close()
+
+    def unlink(self):
+        """Frees the memory. Only the process that made it should do this."""
+        self.memory.close()
+        self.memory.unlink()
+
+    def _serialize(self, value):
+        try:
+            payload = memoryview(value).cast('B')
+            kind = _RAW
+        except TypeError:
+            payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            kind = _PICKLED
+        if len(payload) > self.capacity:
+            raise ValueError("{0} bytes won't fit in a SharedXetum of {1}"
+                             .format(len(payload), self.capacity))
+        return kind, payload
+
+    def _offsets(self, index):
+        header = _HEADER.size + index * _BUFFER_HEADER.size
+        data = _HEADER.size + 2 * _BUFFER_HEADER.size + index * self.capacity
+        return header, data
+
+    def _commit(self, version, kind, payload):
+        # Only called while holding the lock. Fills the buffer that isn't
+        # active and makes it the active one.
+        buf = self.memory.buf
+        active = _HEADER.unpack_from(buf, 0)[1]
+        self._fill(1 - active, version, kind, payload)
+        _HEADER.pack_into(buf, 0, version, 1 - active)
+
+    def _fill(self, index, version, kind, payload):
+        buf = self.memory.buf
+        header, data = self._offsets(index)
+        seq = _BUFFER_HEADER.unpack_from(buf, header)[0]
+        _BUFFER_HEADER.pack_into(buf, header, seq + 1, 0, 0, 0)
+        buf[data:data + len(payload)] = payload
+        _BUFFER_HEADER.pack_into(buf, header, seq + 2, version, len(payload),
+                                 kind)
+
+    def _read(self, fn):
+        # Calls fn(view, version, kind) on the active buffer until it's done
+        # so without the buffer being written meanwhile.
+        buf = self.memory.buf
+        while True:
+            active = _HEADER.unpack_from(buf, 0)[1]
+            header, data = self._offsets(active)
+            seq, version, length, kind = _BUFFER_HEADER.unpack_from(buf,
+                                                                    header)
+            if seq % 2:
+                continue
+            view = buf[data:data + length]
+            try:
+                result = fn(view, version, kind)
+            finally:
+                view.release()
+            if _BUFFER_HEADER.unpack_from(buf, header)[0] == seq:
+                return result
+
+    def read_view(self, fn):
+        """Calls fn(view, version) with a memoryview of the committed bytes,
+        which must have been written as a buffer, and returns what it
+        returns. fn may be called again if a commit overwrote the bytes while
+        it ran, and must not keep the view."""
+        def call(view, version, kind):
+            if kind != _RAW:
+                raise TypeError("the value of this SharedXetum isn't a buffer")
+            return fn(view, version)
+        return self._read(call)
+
+    def read(self):
+        """Returns a copy of the committed value and its version. Values
+        stored as buffers come back as bytes, whatever their type was."""
+        payload, version, kind = self._read(
+                lambda view, version, kind: (bytes(view), version, kind))
+        if kind == _RAW:
+            return payload, version
+        return pickle.loads(payload), version
+
+    def write(self, new_value, version):
+        """Commits new_value if version is still current and returns it and
+        its new version."""
+        # Fail before serializing if someone has already committed over
+        # version.
+        if version != _HEADER.unpack_from(self.memory.buf, 0)[0]:
+            raise XetumWriteException()
+
+        # Phase one. Prepare data.
+        kind, payload = self._serialize(new_value)
+
+        # Phase two. Commit data.
+        with self.lock:
+            if version != _HEADER.unpack_from(self.memory.buf, 0)[0]:
+                raise XetumWriteException()
+            self._commit(version + 1, kind, payload)
+        return new_value, version + 1
+
+    def write_locked(self, fn):
+        """Commits fn(value) while holding the lock, so nothing can commit in
+        between. Returns the committed value and its version."""
+        with self.lock:
+            value, version = self.read()
+            new_value = fn(value)
+            self._commit(version + 1, *self._serialize(new_value))
+        return new_value, version + 1
+
+    @property
+    def data(self):
+        self.value, self.version = self.read()
+        return self.value
+
+    @data.setter
+    def data(self, new_value):
+        self.write(new_value, self.version)
+
+    def transact(self, fn, max_retries=8, backoff=exponential_backoff(),
+                 escalate=True):
+        """Like Xetum.transact. The stats only count this process's
+        transactions."""
+        self.value, self.version = _transact(
+                self.read, self.write, self.write_locked, self.stats, fn,
+                max_retries, backoff, escalate)
+        return self.value
+
+
+if shared_memory is not None:
+    # SharedXetum's examples only run where it does.
+    __test__ = {'SharedXetum': """
+    Two processes count to 100 each:
+
+    >>> context = multiprocessing.get_context('fork')
+    >>> counter = SharedXetum(0, context=context)
+    >>> def count(counter):
+    ...     for _ in range(100):
+    ...         counter.transact(lambda value: value + 1)
+    >>> workers = [context.Process(target=count, args=(counter,))
+    ...            for _ in range(2)]
+    >>> for worker in workers: worker.start()
+    >>> for worker in workers: worker.join()
+    >>> counter.read()
+    (200, 201)
+
+    Buffers are stored as is, read in place and read back as bytes:
+
+    >>> counter.write(bytearray(b'spam'), 201)
+    (bytearray(b'spam'), 202)
+    >>> counter.read_view(lambda view, version: (view[:2].tobytes(), version))
+    (b'sp', 202)
+    >>> counter.read()
+    (b'spam', 202)
+
+    Values must fit in capacity bytes:
+
+    >>> counter.write(bytes(1 << 17), 202)
+    Traceback (most recent call last):
+    ...
+    ValueError: 131072 bytes won't fit in a SharedXetum of 65536
+    >>> counter.read()
+    (b'spam', 202)
+    >>> counter.unlink()
+
+    """}
 
 if __name__ == '__main__':
     def test_xetum(shared_value, sleep_time, remaining):
@@ -77,11 +599,12 @@ if __name__ == '__main__':
                 time.sleep(sleep_time)
                 local_value.data = next_value
                 remaining -= 1
-                print local_value.data, "written by", threading.currentThread().name
+                print(local_value.data, "written by",
+                      threading.currentThread().name)
             except XetumWriteException:
-                print "    {name} failed to write {value}".format(
+                print("    {name} failed to write {value}".format(
                         name=threading.currentThread().name,
-                        value=next_value)
+                        value=next_value))
     threads = []
     shared_value = Xetum(0)
     # These times and quotas are chosen so that they (probably) will produce
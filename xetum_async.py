@@ -0,0 +1,153 @@
+"""The asyncio half of xetum.py. It needs Python 3."""
+
+import asyncio
+import inspect
+import random
+
+import xetum
+
+
+def exponential_backoff(base=0.0005, cap=0.05):
+    """Like xetum.exponential_backoff, but awaits instead of blocking the
+    event loop."""
+    async def backoff(conflicts):
+        await asyncio.sleep(random.uniform(0, min(cap, base * 2 ** conflicts)))
+    return backoff
+
+
+class _AsyncXetumSingleton(object):
+    def __init__(self, to_wrap, snapshot, offload, executor):
+        # Only writers take the lock, and waiting for it yields to the loop.
+        self.lock = asyncio.Lock()
+        self.snapshot = snapshot
+        self.offload = offload
+        self.executor = executor
+        # As in xetum._XetumSingleton, the committed value and its version.
+        self.state = (to_wrap, 1)
+        self.stats = xetum.XetumStats()
+
+    async def _snapshot(self, value):
+        if not self.offload:
+            return self.snapshot(value)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.snapshot, value)
+
+    async def write(self, new_value, version):
+        # Fail before copying if someone has already committed over version.
+        if version != self.state[1]:
+            raise xetum.XetumWriteException()
+
+        # Phase one. Prepare data.
+        wrapped_next = await self._snapshot(new_value)
+
+        # Phase two. Commit data.
+        async with self.lock:
+            if version != self.state[1]:
+                raise xetum.XetumWriteException()
+            self.state = (wrapped_next, version + 1)
+            return self.state
+
+    async def write_locked(self, fn):
+        async with self.lock:
+            wrapped, version = self.state
+            self.state = (await self._snapshot(await _call(fn, wrapped)),
+                          version + 1)
+            return self.state
+
+
+async def _call(fn, value):
+    # transact takes plain functions and coroutine functions alike.
+    result = fn(value)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+class AsyncXetum(object):
+    """A Xetum for coroutines sharing a value on one event loop.
+
+    Nothing blocks the loop: reads are lock-free, commits wait on an
+    asyncio.Lock and the retry loop awaits its backoff. With offload=True
+    the snapshot (a deepcopy by default) runs in executor (the loop's
+    default executor if None) instead of on the loop. The copy still holds
+    the GIL, so this only lets the loop run in between, at the cost of more
+    conflicts while the copies are in flight.
+
+    >>> async def demo():
+    ...     counter = AsyncXetum(0)
+    ...     await asyncio.gather(*[counter.transact(lambda value: value + 1)
+    ...                            for _ in range(100)])
+    ...     return await counter.read()
+    >>> asyncio.run(demo())
+    (100, 101)
+
+    """
+    def __init__(self, to_wrap, snapshot=xetum.deep_snapshot, offload=False,
+                 executor=None):
+        if not isinstance(to_wrap, AsyncXetum):
+            self.xetum_singleton = _AsyncXetumSingleton(
+                    to_wrap, snapshot, offload, executor)
+            self.version = None
+        else:
+            self.xetum_singleton = to_wrap.xetum_singleton
+            self.version = to_wrap.version
+
+    @property
+    def stats(self):
+        return self.xetum_singleton.stats
+
+    async def read(self):
+        """Returns the committed value and its version."""
+        self.value, self.version = self.xetum_singleton.state
+        return self.value, self.version
+
+    async def write(self, new_value, version):
+        """Commits new_value if version, as returned by read, is still
+        current and returns the committed value and its new version. Raises
+        XetumWriteException otherwise.
+
+        Since the version is passed in, coroutines can share one AsyncXetum.
+
+        >>> async def increment(counter):
+        ...     while True:
+        ...         value, version = await counter.read()
+        ...         await asyncio.sleep(0)
+        ...         try:
+        ...             return await counter.write(value + 1, version)
+        ...         except xetum.XetumWriteException:
+        ...             pass
+        >>> async def demo():
+        ...     counter = AsyncXetum(0)
+        ...     await asyncio.gather(*[increment(counter) for _ in range(100)])
+        ...     return await counter.read()
+        >>> asyncio.run(demo())
+        (100, 101)
+
+        """
+        return await self.xetum_singleton.write(new_value, version)
+
+    async def transact(self, fn, max_retries=8,
+                       backoff=exponential_backoff(), escalate=True):
+        """Like Xetum.transact. fn may be a coroutine function, and backoff
+        must be one."""
+        singleton = self.xetum_singleton
+        conflicts = 0
+        while conflicts <= max_retries:
+            value, version = await self.read()
+            new_value = await _call(fn, value)
+            try:
+                self.value, self.version = await singleton.write(new_value,
+                                                                 version)
+            except xetum.XetumWriteException:
+                conflicts += 1
+                if conflicts <= max_retries:
+                    await backoff(conflicts)
+                continue
+            singleton.stats.count(commits=1, conflicts=conflicts)
+            return self.value
+        if not escalate:
+            singleton.stats.count(conflicts=conflicts, failures=1)
+            raise xetum.XetumWriteException()
+        self.value, self.version = await singleton.write_locked(fn)
+        singleton.stats.count(commits=1, conflicts=conflicts, escalations=1)
+        return self.value
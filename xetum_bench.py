@@ -0,0 +1,210 @@
+"""xetum_bench.py measures Xetum against plain mutexes under contention.
+
+Every worker thread shares one value, a list of value_size ints, and does ops
+operations on it. A write_fraction of them are updates: read the value, spend
+compute seconds working on it (sleeping, which stands for work that doesn't
+hold the GIL) and commit a copy with one int changed. The rest are reads.
+
+For Xetum the updates go through Xetum.transact. The baselines hold a
+threading.Lock or RLock for the whole read/compute/commit, and for reads.
+For every combination of thread count, write fraction, compute time and
+value size the benchmark reports commit throughput, the abort (conflict)
+rate and p50/p99 latency of reads and updates.
+
+"""
+
+import argparse
+import itertools
+import random
+import threading
+import timeit
+from multiprocessing.pool import ThreadPool
+
+import xetum
+
+PERCENTILES = (50, 99)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values.
+
+    >>> percentile([4, 1, 3, 2], 50)
+    2
+    >>> percentile([], 99)
+
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, int(round(pct / 100.0 * len(ordered))) - 1)
+    return ordered[rank]
+
+
+class _XetumValue(object):
+    def __init__(self, value, snapshot):
+        self.shared = xetum.Xetum(value, snapshot=snapshot)
+        self.local = threading.local()
+
+    def _xetum(self):
+        # Every thread needs its own Xetum to keep its own version in.
+        if not hasattr(self.local, 'xetum'):
+            self.local.xetum = xetum.Xetum(self.shared)
+        return self.local.xetum
+
+    def read(self):
+        return self._xetum().data
+
+    def update(self, fn):
+        self._xetum().transact(fn)
+
+    def conflicts(self):
+        return self.shared.stats.snapshot()['conflicts']
+
+
+class _LockedValue(object):
+    """The baseline: the value behind a mutex that updates hold throughout."""
+    def __init__(self, value, lock):
+        self.value = value
+        self.lock = lock
+
+    def read(self):
+        with self.lock:
+            return self.value
+
+    def update(self, fn):
+        with self.lock:
+            self.value = fn(self.value)
+
+    def conflicts(self):
+        return 0
+
+
+STRATEGIES = (
+    ('xetum', lambda value: _XetumValue(value, xetum.deep_snapshot)),
+    ('xetum shallow', lambda value: _XetumValue(value, xetum.shallow_snapshot)),
+    ('Lock', lambda value: _LockedValue(value, threading.Lock())),
+    ('RLock', lambda value: _LockedValue(value, threading.RLock())),
+)
+
+
+def _work(shared, ops, write_fraction, compute, seed):
+    rand = random.Random(seed)
+    read_times = []
+    update_times = []
+    def update(value):
+        if compute:
+            threading.Event().wait(compute)
+        next_value = value[:]
+        next_value[rand.randrange(len(next_value))] += 1
+        return next_value
+    for _ in range(ops):
+        start = timeit.default_timer()
+        if rand.random() < write_fraction:
+            shared.update(update)
+            update_times.append(timeit.default_timer() - start)
+        else:
+            shared.read()
+            read_times.append(timeit.default_timer() - start)
+    return read_times, update_times
+
+
+def bench(strategy, threads, ops, write_fraction, compute, value_size,
+          seed=None):
+    """Runs one configuration against one of STRATEGIES' factories."""
+    shared = strategy([0] * value_size)
+    workers = ThreadPool(threads)
+    try:
+        start = timeit.default_timer()
+        results = workers.map(
+                lambda i: _work(shared, ops, write_fraction, compute,
+                                None if seed is None else seed + i),
+                range(threads))
+        elapsed = timeit.default_timer() - start
+    finally:
+        workers.close()
+        workers.join()
+    read_times = [t for reads, _ in results for t in reads]
+    update_times = [t for _, updates in results for t in updates]
+    commits = len(update_times)
+    conflicts = shared.conflicts()
+    # Every update adds 1 somewhere, so the sum checks none were lost.
+    lost = commits - sum(shared.read())
+    return {
+        'commits_per_sec': commits / elapsed,
+        'abort_rate': (float(conflicts) / (commits + conflicts)
+                       if commits + conflicts else 0.0),
+        'read_times': dict((pct, percentile(read_times, pct))
+                           for pct in PERCENTILES),
+        'update_times': dict((pct, percentile(update_times, pct))
+                             for pct in PERCENTILES),
+        'lost_updates': lost,
+    }
+
+
+def sweep(thread_counts, write_fractions, computes, value_sizes, ops,
+          seed=None):
+    """Benchmarks every strategy on every combination of the parameters and
+    returns a list of (config, [(strategy name, result), ...])."""
+    results = []
+    for threads, write_fraction, compute, value_size in itertools.product(
+            thread_counts, write_fractions, computes, value_sizes):
+        config = {'threads': threads, 'write_fraction': write_fraction,
+                  'compute': compute, 'value_size': value_size}
+        results.append((config, [
+                (name, bench(factory, threads, ops, write_fraction, compute,
+                             value_size, seed=seed))
+                for name, factory in STRATEGIES]))
+    return results
+
+
+def _format_us(seconds):
+    return "-" if seconds is None else "{0:.1f}".format(seconds * 1e6)
+
+
+def format_report(results):
+    builder = []
+    for config, strategies in results:
+        builder.append("threads={threads} writes={write_fraction} "
+                       "compute={compute}s value_size={value_size}"
+                       .format(**config))
+        for name, result in strategies:
+            builder.append(
+                    "  {0:>13}: {1[commits_per_sec]:9.0f} commits/sec  "
+                    "aborts {1[abort_rate]:6.1%}  "
+                    "read us p50={2} p99={3}  update us p50={4} p99={5}{6}"
+                    .format(name, result,
+                            _format_us(result['read_times'][50]),
+                            _format_us(result['read_times'][99]),
+                            _format_us(result['update_times'][50]),
+                            _format_us(result['update_times'][99]),
+                            "  LOST {0}".format(result['lost_updates'])
+                            if result['lost_updates'] else ""))
+    return "\n".join(builder)
+
+
+def _numbers(kind):
+    return lambda text: [kind(number) for number in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--threads', type=_numbers(int), default=[1, 2, 4, 8],
+                        help="Comma separated thread counts.")
+    parser.add_argument('--write-fractions', type=_numbers(float),
+                        default=[0.001, 0.1, 0.5])
+    parser.add_argument('--compute', type=_numbers(float), default=[0, 0.001],
+                        help="Comma separated compute phase durations (s).")
+    parser.add_argument('--value-sizes', type=_numbers(int),
+                        default=[1, 1000])
+    parser.add_argument('--ops', type=int, default=2000,
+                        help="Operations per thread.")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    print format_report(sweep(args.threads, args.write_fractions,
+                              args.compute, args.value_sizes, args.ops,
+                              seed=args.seed))
+
+
+if __name__ == '__main__':
+    main()